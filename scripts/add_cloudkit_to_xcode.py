@@ -10,144 +10,178 @@ It generates unique IDs for PBXFileReference and PBXBuildFile entries,
 adds the files to the appropriate group, and adds them to the Sources build phase.
 """
 
-import re
+import hashlib
+import mmap
+import os
 import secrets
+import shutil
 import sys
+from contextlib import contextmanager
 from pathlib import Path
 
+# Bump when the integration logic changes to invalidate existing caches
+CACHE_VERSION = b"v1"
+
+
+def generate_xcode_ids(count: int) -> list:
+    """Generate `count` unique 24-character hexadecimal IDs for Xcode from one entropy read."""
+    raw = secrets.token_hex(12 * count).upper()
+    return [raw[i:i + 24] for i in range(0, len(raw), 24)]
+
 
 def generate_xcode_id() -> str:
     """Generate a unique 24-character hexadecimal ID for Xcode."""
-    return secrets.token_hex(12).upper()
+    return generate_xcode_ids(1)[0]
 
 
-def read_pbxproj(project_path: Path) -> str:
-    """Read the pbxproj file."""
+@contextmanager
+def map_pbxproj(project_path: Path):
+    """Map the pbxproj file read-only, without copying it into Python memory."""
     pbxproj_path = project_path / "project.pbxproj"
     if not pbxproj_path.exists():
         raise FileNotFoundError(f"project.pbxproj not found at {pbxproj_path}")
-    return pbxproj_path.read_text()
-
-
-def write_pbxproj(project_path: Path, content: str):
-    """Write the modified pbxproj file."""
-    pbxproj_path = project_path / "project.pbxproj"
-    pbxproj_path.write_text(content)
-
-
-def add_pbx_file_references(content: str, file_ids: dict) -> str:
-    """
-    Add PBXFileReference entries for CloudKit Swift files.
-
-    Args:
-        content: The pbxproj file content
-        file_ids: Dictionary with 'plugin' and 'service' keys containing IDs
-
-    Returns:
-        Modified content with new PBXFileReference entries
-    """
-    # Find the end of the PBXFileReference section
-    # We want to add before the "/* End PBXFileReference section */" line
-
-    plugin_entry = f"\t\t{file_ids['plugin']} /* CloudKitPlugin.swift */ = {{isa = PBXFileReference; lastKnownFileType = sourcecode.swift; path = CloudKitPlugin.swift; sourceTree = \"<group>\"; }};\n"
-    service_entry = f"\t\t{file_ids['service']} /* CloudKitService.swift */ = {{isa = PBXFileReference; lastKnownFileType = sourcecode.swift; path = CloudKitService.swift; sourceTree = \"<group>\"; }};\n"
+    with open(pbxproj_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            yield content
 
-    # Insert before the "/* End PBXFileReference section */" line
-    pattern = r"(/\* End PBXFileReference section \*/)"
-    replacement = f"{plugin_entry}{service_entry}\\1"
 
-    return re.sub(pattern, replacement, content)
-
-
-def add_pbx_build_files(content: str, build_ids: dict, file_ids: dict) -> str:
+def splice_pbxproj(project_path: Path, content, insertions: list):
     """
-    Add PBXBuildFile entries for CloudKit Swift files.
+    Stream the pbxproj with insertions applied to a temp file, then swap it in.
 
     Args:
-        content: The pbxproj file content
-        build_ids: Dictionary with 'plugin' and 'service' keys containing build file IDs
-        file_ids: Dictionary with 'plugin' and 'service' keys containing file reference IDs
-
-    Returns:
-        Modified content with new PBXBuildFile entries
+        project_path: Path to the Xcode project directory
+        content: The pbxproj file content, typically from map_pbxproj()
+        insertions: Sorted (offset, payload) pairs from pbxproj_insertions()
     """
-    plugin_entry = f"\t\t{build_ids['plugin']} /* CloudKitPlugin.swift in Sources */ = {{isa = PBXBuildFile; fileRef = {file_ids['plugin']} /* CloudKitPlugin.swift */; }};\n"
-    service_entry = f"\t\t{build_ids['service']} /* CloudKitService.swift in Sources */ = {{isa = PBXBuildFile; fileRef = {file_ids['service']} /* CloudKitService.swift */; }};\n"
-
-    # Insert before the "/* End PBXBuildFile section */" line
-    pattern = r"(/\* End PBXBuildFile section \*/)"
-    replacement = f"{plugin_entry}{service_entry}\\1"
-
-    return re.sub(pattern, replacement, content)
+    # Resolve symlinks so the real file is replaced, not the link
+    pbxproj_path = (project_path / "project.pbxproj").resolve()
+    tmp_path = pbxproj_path.with_suffix(".pbxproj.tmp")
+    try:
+        with open(tmp_path, "wb") as out, memoryview(content) as view:
+            prev = 0
+            for offset, payload in insertions:
+                out.write(view[prev:offset])
+                out.write(payload)
+                prev = offset
+            out.write(view[prev:])
+        shutil.copymode(pbxproj_path, tmp_path)
+        os.replace(tmp_path, pbxproj_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def find_file_references_offset(content: bytes) -> int:
+    """Return the offset just before "/* End PBXFileReference section */"."""
+    idx = content.find(b"/* End PBXFileReference section */")
+    if idx == -1:
+        raise ValueError("PBXFileReference section not found in project.pbxproj")
+    return idx
+
+
+def find_build_files_offset(content: bytes) -> int:
+    """Return the offset just before "/* End PBXBuildFile section */"."""
+    idx = content.find(b"/* End PBXBuildFile section */")
+    if idx == -1:
+        raise ValueError("PBXBuildFile section not found in project.pbxproj")
+    return idx
+
+
+def find_runner_group_offset(content: bytes) -> int:
+    """Return the offset of the line closing the Runner group's children."""
+    # Layout: ... = { isa = PBXGroup; children = ( ... ); path = Runner; ... };
+    path_off = content.find(b"path = Runner;")
+    if path_off == -1:
+        raise ValueError("Runner group not found in project.pbxproj")
+
+    # Walk back from the group's path to the ); closing its children list
+    close = content.rfind(b");", 0, path_off)
+    children_open = content.rfind(b"children = (", 0, path_off)
+    if close == -1 or children_open == -1 or children_open > close:
+        raise ValueError("children list not found in Runner group")
+    if content.find(b"};", children_open, path_off) != -1:
+        raise ValueError("Unexpected Runner group layout in project.pbxproj")
+
+    # Insert at the start of the line holding the closing );
+    line_start = content.rfind(b"\n", children_open, close)
+    if line_start == -1:
+        raise ValueError("children list in Runner group is not one entry per line")
+    return line_start + 1
+
+
+def find_sources_build_phase_offset(content: bytes) -> int:
+    """Return the offset of the line closing the Runner Sources build phase files."""
+    # The Sources build phase for Runner is: 97C146EA1CF9000F007C117D
+    # Layout: 97C146EA1CF9000F007C117D /* Sources */ = { ... files = ( ... ); ... };
+    start = content.find(b"97C146EA1CF9000F007C117D /* Sources */ = {")
+    if start == -1:
+        raise ValueError("Runner Sources build phase not found in project.pbxproj")
 
+    files_open = content.find(b"files = (", start)
+    block_end = content.find(b"};", start)
+    if files_open == -1 or (block_end != -1 and files_open > block_end):
+        raise ValueError("files list not found in Runner Sources build phase")
 
-def add_to_runner_group(content: str, file_ids: dict) -> str:
-    """
-    Add CloudKit Swift files to the Runner group.
+    close = content.find(b");", files_open)
+    if close == -1:
+        raise ValueError("Unterminated files list in Runner Sources build phase")
 
-    The Runner group's children list needs to include the new file references.
+    # Insert at the start of the line holding the closing );
+    line_start = content.rfind(b"\n", files_open, close)
+    if line_start == -1:
+        raise ValueError("files list in Runner Sources build phase is not one entry per line")
+    return line_start + 1
 
-    Args:
-        content: The pbxproj file content
-        file_ids: Dictionary with 'plugin' and 'service' keys containing file reference IDs
 
-    Returns:
-        Modified content with files added to Runner group
-    """
-    plugin_ref = f"\t\t\t\t{file_ids['plugin']} /* CloudKitPlugin.swift */,\n"
-    service_ref = f"\t\t\t\t{file_ids['service']} /* CloudKitService.swift */,\n"
+def file_reference_entries(file_ids: dict) -> bytes:
+    """Build the PBXFileReference entries for CloudKit Swift files."""
+    plugin_entry = b"\t\t%s /* CloudKitPlugin.swift */ = {isa = PBXFileReference; lastKnownFileType = sourcecode.swift; path = CloudKitPlugin.swift; sourceTree = \"<group>\"; };\n" % file_ids['plugin'].encode()
+    service_entry = b"\t\t%s /* CloudKitService.swift */ = {isa = PBXFileReference; lastKnownFileType = sourcecode.swift; path = CloudKitService.swift; sourceTree = \"<group>\"; };\n" % file_ids['service'].encode()
+    return plugin_entry + service_entry
 
-    # The Runner group ends with the bridging header reference followed by closing
-    # We need to insert our files before the closing ); of the children array
-    # Pattern: \t\t\t\t74858FAD1ED2DC5600515810 /* Runner-Bridging-Header.h */,\n\t\t\t);
 
-    runner_group_pattern = r"(74858FAD1ED2DC5600515810 /\* Runner-Bridging-Header\.h \*/,\n)(\t\t\t\);)"
+def build_file_entries(build_ids: dict, file_ids: dict) -> bytes:
+    """Build the PBXBuildFile entries for CloudKit Swift files."""
+    plugin_entry = b"\t\t%s /* CloudKitPlugin.swift in Sources */ = {isa = PBXBuildFile; fileRef = %s /* CloudKitPlugin.swift */; };\n" % (build_ids['plugin'].encode(), file_ids['plugin'].encode())
+    service_entry = b"\t\t%s /* CloudKitService.swift in Sources */ = {isa = PBXBuildFile; fileRef = %s /* CloudKitService.swift */; };\n" % (build_ids['service'].encode(), file_ids['service'].encode())
+    return plugin_entry + service_entry
 
-    def runner_group_replacer(match):
-        header_line = match.group(1)
-        closing = match.group(2)
-        return f"{header_line}{plugin_ref}{service_ref}{closing}"
 
-    result = re.sub(runner_group_pattern, runner_group_replacer, content)
+def runner_group_refs(file_ids: dict) -> bytes:
+    """Build the Runner group children entries for CloudKit Swift files."""
+    plugin_ref = b"\t\t\t\t%s /* CloudKitPlugin.swift */,\n" % file_ids['plugin'].encode()
+    service_ref = b"\t\t\t\t%s /* CloudKitService.swift */,\n" % file_ids['service'].encode()
+    return plugin_ref + service_ref
 
-    # If pattern didn't match (maybe file order changed), try alternative approach
-    if result == content:
-        # Look for any line ending with ); after children in Runner group
-        # Match the last child reference before closing
-        alt_pattern = r"(\t\t\t\t[A-F0-9]{24} /\* [^*]+ \*/,\n)(\t\t\t\);\n\t\t\tpath = Runner;\n\t\t\tsourceTree = \"<group>\";)"
-        result = re.sub(alt_pattern, lambda m: m.group(1) + plugin_ref + service_ref + m.group(2), result)
 
-    return result
+def sources_build_phase_refs(build_ids: dict) -> bytes:
+    """Build the Sources build phase file entries for CloudKit Swift files."""
+    plugin_ref = b"\t\t\t\t%s /* CloudKitPlugin.swift in Sources */,\n" % build_ids['plugin'].encode()
+    service_ref = b"\t\t\t\t%s /* CloudKitService.swift in Sources */,\n" % build_ids['service'].encode()
+    return plugin_ref + service_ref
 
 
-def add_to_sources_build_phase(content: str, build_ids: dict) -> str:
+def pbxproj_insertions(content: bytes, file_ids: dict, build_ids: dict) -> list:
     """
-    Add CloudKit Swift files to the Sources build phase.
+    Locate every CloudKit insertion point in the pbxproj content.
 
     Args:
         content: The pbxproj file content
+        file_ids: Dictionary with 'plugin' and 'service' keys containing file reference IDs
         build_ids: Dictionary with 'plugin' and 'service' keys containing build file IDs
 
     Returns:
-        Modified content with build files added to Sources phase
+        (offset, payload) pairs sorted by offset
     """
-    # The Sources build phase for Runner is: 97C146EA1CF9000F007C117D
-    # We need to add the build file references to the files array
-
-    plugin_ref = f"\t\t\t\t{build_ids['plugin']} /* CloudKitPlugin.swift in Sources */,\n"
-    service_ref = f"\t\t\t\t{build_ids['service']} /* CloudKitService.swift in Sources */,\n"
-
-    # Find the Sources build phase for Runner and add files to it
-    # Pattern: 97C146EA1CF9000F007C117D /* Sources */ = { ... files = ( ... ); ... };
-
-    sources_phase_pattern = r"(97C146EA1CF9000F007C117D /\* Sources \*/ = \{\s*isa = PBXSourcesBuildPhase;\s*buildActionMask = 2147483647;\s*files = \(\s*[^)]*?)(\t\t\);)"
-
-    def sources_replacer(match):
-        files_content = match.group(1)
-        closing = match.group(2)
-        return f"{files_content}{plugin_ref}{service_ref}{closing}"
-
-    return re.sub(sources_phase_pattern, sources_replacer, content, flags=re.DOTALL)
+    return sorted(
+        [
+            (find_build_files_offset(content), build_file_entries(build_ids, file_ids)),
+            (find_file_references_offset(content), file_reference_entries(file_ids)),
+            (find_runner_group_offset(content), runner_group_refs(file_ids)),
+            (find_sources_build_phase_offset(content), sources_build_phase_refs(build_ids)),
+        ],
+        key=lambda insertion: insertion[0],
+    )
 
 
 def modify_pbxproj(project_path: Path) -> bool:
@@ -158,42 +192,41 @@ def modify_pbxproj(project_path: Path) -> bool:
         project_path: Path to the Xcode project directory
 
     Returns:
-        True if successful, False otherwise
+        True if the pbxproj was modified, False if it already contained
+        both CloudKit files
     """
-    content = read_pbxproj(project_path)
-
-    # Generate unique IDs
-    file_ids = {
-        'plugin': generate_xcode_id(),
-        'service': generate_xcode_id(),
-    }
-    build_ids = {
-        'plugin': generate_xcode_id(),
-        'service': generate_xcode_id(),
-    }
-
-    print(f"Generated PBXFileReference IDs:")
-    print(f"  CloudKitPlugin.swift: {file_ids['plugin']}")
-    print(f"  CloudKitService.swift: {file_ids['service']}")
-    print(f"Generated PBXBuildFile IDs:")
-    print(f"  CloudKitPlugin.swift: {build_ids['plugin']}")
-    print(f"  CloudKitService.swift: {build_ids['service']}")
-
-    # Modify the content in order
-    content = add_pbx_build_files(content, build_ids, file_ids)
-    print("Added PBXBuildFile entries")
+    with map_pbxproj(project_path) as content:
+        # Skip the rewrite entirely if both files are already registered
+        if (content.find(b"CloudKitPlugin.swift") != -1
+                and content.find(b"CloudKitService.swift") != -1):
+            return False
+
+        # Generate unique IDs
+        plugin_file_id, service_file_id, plugin_build_id, service_build_id = generate_xcode_ids(4)
+        file_ids = {
+            'plugin': plugin_file_id,
+            'service': service_file_id,
+        }
+        build_ids = {
+            'plugin': plugin_build_id,
+            'service': service_build_id,
+        }
+
+        print(f"Generated PBXFileReference IDs:")
+        print(f"  CloudKitPlugin.swift: {file_ids['plugin']}")
+        print(f"  CloudKitService.swift: {file_ids['service']}")
+        print(f"Generated PBXBuildFile IDs:")
+        print(f"  CloudKitPlugin.swift: {build_ids['plugin']}")
+        print(f"  CloudKitService.swift: {build_ids['service']}")
+
+        # Locate every insertion point, then stream the result in a single pass
+        insertions = pbxproj_insertions(content, file_ids, build_ids)
+        splice_pbxproj(project_path, content, insertions)
 
-    content = add_pbx_file_references(content, file_ids)
+    print("Added PBXBuildFile entries")
     print("Added PBXFileReference entries")
-
-    content = add_to_runner_group(content, file_ids)
     print("Added files to Runner group")
-
-    content = add_to_sources_build_phase(content, build_ids)
     print("Added files to Sources build phase")
-
-    # Write the modified content
-    write_pbxproj(project_path, content)
     print(f"Updated {project_path / 'project.pbxproj'}")
 
     return True
@@ -224,6 +257,32 @@ def verify_files_exist(project_root: Path) -> bool:
     return True
 
 
+def compute_cache_key(project_root: Path, xcode_project: Path) -> str:
+    """
+    Fingerprint the inputs of a CloudKit integration run.
+
+    Hashes both Swift sources, the pbxproj size and mtime (so a reset or
+    regenerated project invalidates the cache without reading it), and
+    CACHE_VERSION.
+
+    Args:
+        project_root: Root path of the project
+        xcode_project: Path to the Xcode project directory
+
+    Returns:
+        Hex digest identifying the current inputs
+    """
+    runner_dir = project_root / "ios" / "Runner"
+    pbxproj_stat = (xcode_project / "project.pbxproj").stat()
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update((runner_dir / "CloudKitPlugin.swift").read_bytes())
+    digest.update((runner_dir / "CloudKitService.swift").read_bytes())
+    digest.update(b"%d:%d" % (pbxproj_stat.st_size, pbxproj_stat.st_mtime_ns))
+    digest.update(CACHE_VERSION)
+    return digest.hexdigest()
+
+
 def main():
     """Main entry point."""
     # Get the project root directory (assuming script is in scripts/ at project root)
@@ -241,12 +300,37 @@ def main():
         print(f"Error: Xcode project not found at {xcode_project}")
         sys.exit(1)
 
+    pbxproj_path = xcode_project / "project.pbxproj"
+    if not pbxproj_path.exists():
+        print(f"Error: project.pbxproj not found at {pbxproj_path}")
+        sys.exit(1)
+
+    # Skip reading the pbxproj entirely if nothing changed since the last run
+    cache_path = project_root / "scripts" / ".add_cloudkit_cache"
+    cache_key = compute_cache_key(project_root, xcode_project)
+    try:
+        cached_key = cache_path.read_text().strip()
+    except OSError:
+        cached_key = None
+    if cached_key == cache_key:
+        print("Up to date: CloudKit files already added to Xcode project")
+        sys.exit(0)
+
     print(f"Modifying Xcode project at: {xcode_project}")
     print()
 
     # Modify the pbxproj file
     try:
-        if modify_pbxproj(xcode_project):
+        modified = modify_pbxproj(xcode_project)
+
+        # Re-key after the write, since it changes the pbxproj mtime.
+        # The cache is only an optimisation, so failing to write it is not fatal.
+        try:
+            cache_path.write_text(compute_cache_key(project_root, xcode_project))
+        except OSError as e:
+            print(f"Warning: could not write {cache_path}: {e}")
+
+        if modified:
             print()
             print("Successfully added CloudKit files to Xcode project!")
             print()
@@ -255,8 +339,7 @@ def main():
             print("  2. Verify CloudKitPlugin.swift and CloudKitService.swift appear in the Runner group")
             print("  3. Build the project to ensure everything compiles")
         else:
-            print("Error: Failed to modify pbxproj file")
-            sys.exit(1)
+            print("CloudKit files already integrated, nothing to do")
     except Exception as e:
         print(f"Error: {e}")
         import traceback